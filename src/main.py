@@ -3,23 +3,87 @@ FastAPI Controller para gerenciar VMs do Google Cloud Platform
 Permite ligar, desligar e monitorar VMs remotamente
 """
 
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from google.api_core import exceptions as gexc
 from google.cloud import compute_v1
 import os
+import time
+import hashlib
+import asyncio
 import httpx
+import orjson
 import logging
-from typing import Dict, Any
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# URL base da VM de ML (HTTPS via domain)
+ML_VM_BASE_URL = "https://vm-yolo.tecflorestal.dev"
+ML_MAX_CONNECTIONS = 100
+
+# Limite de requests simultâneos para a VM de ML (nunca acima do pool de conexões)
+# O limite vale por processo: cada instância do Cloud Run tem o seu
+ML_PROXY_CONCURRENCY = min(int(os.getenv("ML_PROXY_CONCURRENCY", "32")), ML_MAX_CONNECTIONS)
+_ml_sem = asyncio.Semaphore(ML_PROXY_CONCURRENCY)
+
+# Headers que não devem ser repassados pelo proxy (hop-by-hop e host)
+_HOP_BY_HOP_HEADERS = frozenset({
+    "host",
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+    "upgrade",
+    "proxy-connection",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer"
+})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Valida a configuração e cria o cliente HTTP persistente para a VM de ML"""
+    # Sem projeto configurado nenhuma chamada ao GCE funciona, então falha no boot
+    if not PROJECT_ID:
+        raise RuntimeError("GCP_PROJECT_ID não configurado")
+    
+    # Conexões keep-alive reaproveitadas entre requests evitam novo handshake TCP+TLS
+    app.state.ml_client = httpx.AsyncClient(
+        base_url=ML_VM_BASE_URL,
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=20,
+            max_connections=ML_MAX_CONNECTIONS,
+            keepalive_expiry=30.0
+        ),
+        timeout=httpx.Timeout(connect=5.0, read=300.0, write=300.0, pool=5.0)
+    )
+    # Refresh em background do status da VM, apenas quando habilitado
+    refresh_task = None
+    if VM_STATUS_REFRESH_INTERVAL > 0:
+        refresh_task = asyncio.create_task(_refresh_vm_info_loop())
+    try:
+        yield
+    finally:
+        if refresh_task is not None:
+            refresh_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await refresh_task
+        await app.state.ml_client.aclose()
+
 app = FastAPI(
     title="Açaí VM Controller",
     description="API para controlar VMs do GCP para processamento de açaí",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS para permitir requisições do frontend
@@ -35,13 +99,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    """
+    Retorna 500 genérico para erros inesperados
+    Este handler roda fora do CORSMiddleware, então o header de CORS é adicionado aqui
+    para o frontend conseguir ler o erro. O traceback já é logado pelo uvicorn.
+    """
+    return ORJSONResponse(
+        status_code=500,
+        content={"detail": "Erro interno do servidor"},
+        headers={"Access-Control-Allow-Origin": "*"}
+    )
+
 # Configurações do ambiente
 PROJECT_ID = os.getenv("GCP_PROJECT_ID")
 ZONE = os.getenv("VM_ZONE", "us-central1-a")
 VM_NAME = os.getenv("VM_NAME", "acai-detector-vm")
 
-# Cliente do Compute Engine
+# Clientes do Compute Engine (síncronos: chamadas rodam no threadpool para não bloquear o event loop)
 compute_client = compute_v1.InstancesClient()
+operations_client = compute_v1.ZoneOperationsClient()
+
+# Cache curto do status da VM para não consultar o GCE a cada request do proxy
+_status_cache = {"vm_info": None, "expires": 0.0}
+_status_inflight: asyncio.Task | None = None
+
+# Intervalo do refresh em background do status da VM (segundos); 0 desabilita
+# Só faz sentido com CPU sempre alocada (--no-cpu-throttling no Cloud Run): com o
+# deploy atual (--cpu-throttling) a task quase não roda entre requests e o proxy
+# usaria a consulta sob demanda (TTL + single-flight) de qualquer forma
+VM_STATUS_REFRESH_INTERVAL = float(os.getenv("VM_STATUS_REFRESH_INTERVAL", "0"))
 
 @app.get("/")
 async def root():
@@ -59,20 +147,40 @@ async def health_check():
     """Health check para container"""
     return {"status": "healthy", "service": "acai-vm-controller"}
 
+async def _fetch_instance():
+    """Busca a instância da VM no GCE (objeto bruto, sem serializar)"""
+    return await run_in_threadpool(
+        compute_client.get,
+        project=PROJECT_ID,
+        zone=ZONE,
+        instance=VM_NAME
+    )
+
+def _extract_external_ip(instance):
+    """Retorna o primeiro IP externo da instância, ou None"""
+    return next(
+        (ac.nat_i_p for ni in instance.network_interfaces for ac in ni.access_configs if ac.nat_i_p),
+        None
+    )
+
+@dataclass(slots=True)
+class VmInfo:
+    """Resumo da VM usado internamente (status e IP externo)"""
+    status: str
+    external_ip: str | None
+
+async def _vm_info() -> VmInfo:
+    """Consulta a VM no GCE e retorna apenas o que os handlers internos precisam"""
+    instance = await _fetch_instance()
+    return VmInfo(status=instance.status, external_ip=_extract_external_ip(instance))
+
 @app.get("/vm/status")
-async def get_vm_status():
-    """Retorna status atual da VM"""
+async def get_vm_status(request: Request):
+    """Retorna status atual da VM (com ETag para polling do frontend)"""
     try:
-        if not PROJECT_ID:
-            raise HTTPException(status_code=500, detail="GCP_PROJECT_ID não configurado")
-        
-        instance = compute_client.get(
-            project=PROJECT_ID,
-            zone=ZONE,
-            instance=VM_NAME
-        )
+        instance = await _fetch_instance()
         
-        return {
+        vm_status = {
             "status": instance.status,
             "name": instance.name,
             "zone": ZONE,
@@ -88,83 +196,134 @@ async def get_vm_status():
                 for ni in instance.network_interfaces
             ]
         }
-    except Exception as e:
-        logger.error(f"Erro ao obter status da VM: {e}")
+        
+        # ETag calculado sobre o corpo serializado, então cobre todos os campos retornados
+        content = orjson.dumps(vm_status)
+        etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        return Response(content=content, media_type="application/json", headers={"ETag": etag})
+    except gexc.GoogleAPICallError as e:
+        logger.error("Erro ao obter status da VM: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro ao obter status da VM: {str(e)}")
 
+async def _load_vm_info(ttl_running: float, ttl_other: float) -> VmInfo:
+    """Consulta o GCE e grava o resumo da VM no cache"""
+    vm_info = await _vm_info()
+    ttl = ttl_running if vm_info.status == "RUNNING" else ttl_other
+    _status_cache["vm_info"] = vm_info
+    _status_cache["expires"] = time.monotonic() + ttl
+    return vm_info
+
+def _clear_status_inflight(task: asyncio.Task):
+    """Remove a consulta concluída do single-flight"""
+    global _status_inflight
+    if _status_inflight is task:
+        _status_inflight = None
+    # Marca a exceção como lida caso todos os chamadores tenham sido cancelados
+    if not task.cancelled():
+        task.exception()
+
+async def _cached_vm_info(ttl_running: float = 30.0, ttl_other: float = 3.0) -> VmInfo:
+    """
+    Retorna o resumo da VM usando cache com TTL
+    RUNNING raramente muda no meio do uso, então fica mais tempo em cache
+    """
+    global _status_inflight
+    
+    if _status_cache["vm_info"] is not None and time.monotonic() < _status_cache["expires"]:
+        return _status_cache["vm_info"]
+    
+    # Single-flight: a consulta ao GCE roda numa task compartilhada que todos aguardam
+    # via shield, então cancelar um chamador (inclusive o primeiro) não afeta os outros
+    if _status_inflight is None:
+        _status_inflight = asyncio.ensure_future(_load_vm_info(ttl_running, ttl_other))
+        _status_inflight.add_done_callback(_clear_status_inflight)
+    return await asyncio.shield(_status_inflight)
+
+async def _refresh_vm_info_loop():
+    """Mantém o cache do status da VM atualizado para o proxy não esperar o GCE"""
+    while True:
+        try:
+            vm_info = await _vm_info()
+            _status_cache["vm_info"] = vm_info
+            # Margem acima do intervalo: se o refresh parar de funcionar, o cache vence
+            # e o proxy volta a consultar o GCE diretamente
+            _status_cache["expires"] = time.monotonic() + 2 * VM_STATUS_REFRESH_INTERVAL
+        except Exception as e:
+            # A task precisa sobreviver a qualquer falha para continuar atualizando
+            logger.warning("Falha ao atualizar status da VM em background: %s", e)
+        await asyncio.sleep(VM_STATUS_REFRESH_INTERVAL)
+
 @app.post("/vm/start")
 async def start_vm():
     """Liga a VM"""
     try:
-        if not PROJECT_ID:
-            raise HTTPException(status_code=500, detail="GCP_PROJECT_ID não configurado")
-            
         # Verificar se já está rodando
-        current_status = await get_vm_status()
-        if current_status["status"] == "RUNNING":
+        vm_info = await _vm_info()
+        if vm_info.status == "RUNNING":
             return {
                 "message": "VM já está rodando",
                 "status": "running"
             }
         
-        operation = compute_client.start(
+        operation = await run_in_threadpool(
+            compute_client.start,
             project=PROJECT_ID,
             zone=ZONE,
             instance=VM_NAME
         )
         
-        logger.info(f"VM {VM_NAME} iniciando... Operação: {operation.name}")
+        logger.info("VM %s iniciando... Operação: %s", VM_NAME, operation.name)
+        _status_cache["expires"] = 0.0
         
         return {
             "message": f"VM {VM_NAME} iniciando...",
             "operation_id": operation.name,
             "status": "starting"
         }
-    except Exception as e:
-        logger.error(f"Erro ao iniciar VM: {e}")
+    except gexc.GoogleAPICallError as e:
+        logger.error("Erro ao iniciar VM: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro ao iniciar VM: {str(e)}")
 
 @app.post("/vm/stop")
 async def stop_vm():
     """Desliga a VM"""
     try:
-        if not PROJECT_ID:
-            raise HTTPException(status_code=500, detail="GCP_PROJECT_ID não configurado")
-            
         # Verificar se já está parada
-        current_status = await get_vm_status()
-        if current_status["status"] == "TERMINATED":
+        vm_info = await _vm_info()
+        if vm_info.status == "TERMINATED":
             return {
                 "message": "VM já está parada",
                 "status": "stopped"
             }
         
-        operation = compute_client.stop(
+        operation = await run_in_threadpool(
+            compute_client.stop,
             project=PROJECT_ID,
             zone=ZONE,
             instance=VM_NAME
         )
         
-        logger.info(f"VM {VM_NAME} parando... Operação: {operation.name}")
+        logger.info("VM %s parando... Operação: %s", VM_NAME, operation.name)
+        _status_cache["expires"] = 0.0
         
         return {
             "message": f"VM {VM_NAME} parando...",
             "operation_id": operation.name,
             "status": "stopping"
         }
-    except Exception as e:
-        logger.error(f"Erro ao parar VM: {e}")
+    except gexc.GoogleAPICallError as e:
+        logger.error("Erro ao parar VM: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro ao parar VM: {str(e)}")
 
 @app.get("/vm/operations/{operation_id}")
 async def get_operation_status(operation_id: str):
     """Verifica status de uma operação da VM"""
     try:
-        if not PROJECT_ID:
-            raise HTTPException(status_code=500, detail="GCP_PROJECT_ID não configurado")
-            
-        operations_client = compute_v1.ZoneOperationsClient()
-        operation = operations_client.get(
+        operation = await run_in_threadpool(
+            operations_client.get,
             project=PROJECT_ID,
             zone=ZONE,
             operation=operation_id
@@ -179,8 +338,8 @@ async def get_operation_status(operation_id: str):
             "insert_time": operation.insert_time,
             "end_time": operation.end_time if hasattr(operation, 'end_time') else None
         }
-    except Exception as e:
-        logger.error(f"Erro ao verificar operação {operation_id}: {e}")
+    except gexc.GoogleAPICallError as e:
+        logger.error("Erro ao verificar operação %s: %s", operation_id, e)
         raise HTTPException(status_code=500, detail=f"Erro ao verificar operação: {str(e)}")
 
 @app.get("/vm/connection-info")
@@ -190,20 +349,16 @@ async def get_vm_connection_info():
     Frontend usa isso para conectar diretamente na VM
     """
     try:
-        vm_status = await get_vm_status()
+        vm_info = await _vm_info()
         
-        if vm_status["status"] != "RUNNING":
+        if vm_info.status != "RUNNING":
             raise HTTPException(
                 status_code=503, 
-                detail=f"VM não está rodando (status: {vm_status['status']}). Ligue a VM primeiro."
+                detail=f"VM não está rodando (status: {vm_info.status}). Ligue a VM primeiro."
             )
         
         # Obter IP externo da VM
-        external_ip = None
-        for ni in vm_status["network_interfaces"]:
-            if ni["external_ip"]:
-                external_ip = ni["external_ip"]
-                break
+        external_ip = vm_info.external_ip
         
         if not external_ip:
             raise HTTPException(
@@ -221,12 +376,47 @@ async def get_vm_connection_info():
             "message": "VM está rodando e pronta para receber uploads diretos via HTTPS"
         }
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Erro ao obter informações de conexão da VM: {e}")
+    except gexc.GoogleAPICallError as e:
+        logger.error("Erro ao obter informações de conexão da VM: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro ao obter informações da VM: {str(e)}")
 
+class _UpstreamBody:
+    """
+    Itera o corpo da resposta da VM e libera conexão e vaga do semáforo ao terminar
+    release() é chamado tanto no fim da iteração quanto no background da resposta,
+    pois o Starlette pode pular um dos dois (erro no meio do stream ou cliente desconectado)
+    """
+    
+    def __init__(self, response: httpx.Response):
+        self.response = response
+        self._released = False
+    
+    async def __aiter__(self):
+        try:
+            async for chunk in self.response.aiter_raw():
+                yield chunk
+        finally:
+            await self.release()
+    
+    async def release(self):
+        if self._released:
+            return
+        self._released = True
+        # Semáforo liberado antes do await, para não vazar a vaga se houver cancelamento
+        _ml_sem.release()
+        await self.response.aclose()
+
+# Resposta de preflight CORS é estática, então é criada uma única vez
+_PREFLIGHT_RESPONSE = Response(
+    status_code=200,
+    headers={
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+        "Access-Control-Allow-Headers": "*",
+        "Access-Control-Max-Age": "86400"
+    }
+)
+
 # Manter o proxy apenas para endpoints leves (não upload)
 @app.api_route("/ml/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
 async def proxy_to_ml_vm(path: str, request: Request):
@@ -244,30 +434,18 @@ async def proxy_to_ml_vm(path: str, request: Request):
         
         # Tratar requisições OPTIONS (preflight CORS) diretamente
         if request.method == "OPTIONS":
-            return Response(
-                status_code=200,
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-                    "Access-Control-Allow-Headers": "*",
-                    "Access-Control-Max-Age": "86400"
-                }
-            )
+            return _PREFLIGHT_RESPONSE
         
-        # Verificar se VM está rodando
-        vm_status = await get_vm_status()
-        if vm_status["status"] != "RUNNING":
+        # Verificar se VM está rodando (cache com TTL)
+        vm_info = await _cached_vm_info()
+        if vm_info.status != "RUNNING":
             raise HTTPException(
                 status_code=503, 
-                detail=f"VM não está rodando (status: {vm_status['status']}). Ligue a VM primeiro."
+                detail=f"VM não está rodando (status: {vm_info.status}). Ligue a VM primeiro."
             )
         
         # Obter IP externo da VM
-        external_ip = None
-        for ni in vm_status["network_interfaces"]:
-            if ni["external_ip"]:
-                external_ip = ni["external_ip"]
-                break
+        external_ip = vm_info.external_ip
         
         if not external_ip:
             raise HTTPException(
@@ -277,25 +455,39 @@ async def proxy_to_ml_vm(path: str, request: Request):
         
         # Fazer proxy do request
         #url = f"http://{external_ip}:5000/{path}"    #quando for rodar localmente
-        url = f"https://vm-yolo.tecflorestal.dev/{path}"    #usando HTTPS via domain
+        # URL absoluta: com base_url, um path iniciado por "/" viraria "//host/..." e perderia segmentos
+        url = f"{ML_VM_BASE_URL}/{path}"    #usando HTTPS via domain
         
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            # Preparar headers
-            headers = dict(request.headers)
-            if "host" in headers:
-                del headers["host"]
-            
-            # Fazer request para a VM
-            response = await client.request(
-                method=request.method,
-                url=url,
-                content=await request.body(),
-                headers=headers,
-                params=request.query_params
-            )
-            
+        client = request.app.state.ml_client
+
+        # Preparar headers (lista de pares, sem reconstruir dict)
+        headers = [(k, v) for k, v in request.headers.items() if k not in _HOP_BY_HOP_HEADERS]
+        
+        # Corpo repassado em chunks, sem bufferizar em memória. Content-Length do cliente
+        # é mantido; uploads chunked seguem como Transfer-Encoding: chunked via httpx.
+        # Requests sem corpo (ex.: GET) não enviam corpo chunked vazio para a VM.
+        has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+        
+        # Fazer request para a VM
+        upstream_request = client.build_request(
+            method=request.method,
+            url=url,
+            content=request.stream() if has_body else None,
+            headers=headers,
+            params=request.query_params
+        )
+        # A vaga do semáforo fica presa até o corpo da VM terminar de ser repassado
+        await _ml_sem.acquire()
+        try:
+            response = await client.send(upstream_request, stream=True)
+        except BaseException:
+            _ml_sem.release()
+            raise
+        
+        upstream_body = _UpstreamBody(response)
+        try:
             # Preparar headers de resposta preservando CORS da VM
-            response_headers = dict(response.headers)
+            response_headers = {k: v for k, v in response.headers.items() if k not in _HOP_BY_HOP_HEADERS}
             
             # Garantir headers de CORS essenciais
             cors_headers = {
@@ -307,22 +499,30 @@ async def proxy_to_ml_vm(path: str, request: Request):
             # Mesclar headers preservando os da VM quando existirem
             final_headers = {**cors_headers, **response_headers}
             
-            # Retornar response completa com headers corrigidos
-            return Response(
-                content=response.content,
+            # Repassar o corpo da VM em chunks; conexão e vaga são liberadas ao fim do envio
+            return StreamingResponse(
+                upstream_body,
                 status_code=response.status_code,
                 headers=final_headers,
-                media_type=response.headers.get("content-type")
+                media_type=response.headers.get("content-type"),
+                background=BackgroundTask(upstream_body.release)
             )
-            
+        except BaseException:
+            await upstream_body.release()
+            raise
+        
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Timeout ao conectar com a VM")
     except httpx.ConnectError:
         raise HTTPException(status_code=503, detail="Não foi possível conectar com a VM")
-    except Exception as e:
-        logger.error(f"Erro no proxy para VM: {e}")
+    except httpx.HTTPError as e:
+        logger.error("Erro na comunicação com a VM: %s", e)
+        raise HTTPException(status_code=502, detail=f"Erro na comunicação com a VM: {str(e)}")
+    except gexc.GoogleAPICallError as e:
+        logger.error("Erro no proxy para VM: %s", e)
         raise HTTPException(status_code=500, detail=f"Erro no proxy: {str(e)}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080) 
\ No newline at end of file
+    # Um único processo por container: o Cloud Run escala por instâncias
+    uvicorn.run(app, host="0.0.0.0", port=8080, loop="uvloop", http="httptools")